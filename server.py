@@ -2,13 +2,29 @@
 
 import os
 from argparse import ArgumentParser
-from inspect import getdoc
-from json import loads, dumps
+from collections import deque
+from functools import lru_cache
 from random import randint
 from socket import getfqdn
+from struct import pack
 from time import ctime
+from typing import Callable, ClassVar, Deque, Dict, List, Optional, Set, Tuple
 from jinja2 import Environment, FileSystemLoader
 from markdown import Markdown
+from msgspec import Struct
+from msgspec.json import Decoder
+from orjson import dumps
+# Run Twisted on top of uvloop's event loop where it is available. This has to
+# happen before anything (including Klein) imports the reactor.
+try:
+    import uvloop
+except ImportError:  # Not installed, or not supported on this platform.
+    pass
+else:
+    from twisted.internet import asyncioreactor
+    asyncioreactor.install(uvloop.new_event_loop())
+from twisted.internet import reactor
+from twisted.internet.interfaces import ITCPTransport
 from twisted.python import log  # Used by Klein (annoyingly).
 from twisted.web.static import File
 from klein import Klein
@@ -39,16 +55,56 @@ parser.add_argument(
     help='The name to use when sending system messages'
 )
 
+parser.add_argument(
+    '-o', '--outbox-size', type=int, default=256,
+    help='The number of messages to hold for a client which is reading slowly'
+)
+
+parser.add_argument(
+    '-m', '--max-drops', type=int, default=256,
+    help='The number of messages a client can miss before being disconnected'
+)
+
+parser.add_argument(
+    '-s', '--max-message-size', type=int, default=4096,
+    help='The largest message (in bytes) a client is allowed to send'
+)
+
+
+connections: Set['WebSocketProtocol'] = set()  # All connected clients.
+# The names that are already in use, and who is using them.
+names: Dict[str, Optional['WebSocketProtocol']] = {}
+commands: Dict[str, Callable[..., None]] = {}  # The supported commands.
+command_docs: Dict[str, str] = {}  # The docstrings of the supported commands.
+# (message, name, frame) waiting to be sent.
+pending_broadcasts: List[Tuple[str, str, bytes]] = []
 
-connections = []  # A list of all connected clients.
-names = set()  # The names that are already in use.
-commands = {}  # The supported commands.
+# Almost everything sent to clients is a message, and they all look the same
+# apart from the name and the text, so only those need encoding.
+message_template = b'{"name":"message","args":[%b,%b],"kwargs":{}}'
+
+
+class CommandMessage(Struct, array_like=True, forbid_unknown_fields=True):
+    """A command sent by a client. These are sent as json arrays of exactly
+    the form [name, args, kwargs]."""
+
+    name: str
+    args: list
+    kwargs: dict
+
+
+# Decodes and validates incoming data in one go.
+decoder = Decoder(CommandMessage)
 
 
 def command(func):
     """Decorator to add a command to the commands dictionary. Couple with
-    @no_args if you want a command that takes no arguments."""
+    @no_args if you want a command that takes no arguments. The docstring is
+    stored too, with the indentation removed, for use by the help command."""
     commands[func.__name__] = func
+    command_docs[func.__name__] = '\n'.join(
+        line.strip() for line in (func.__doc__ or '').strip().splitlines()
+    )
     return func
 
 
@@ -69,58 +125,170 @@ def no_arguments(func):
     return inner
 
 
-def send_message(message, name=None):
+@lru_cache(maxsize=4096)
+def encode_name(name: str) -> bytes:
+    """Return name encoded as json. The same few names send most messages, so
+    the results are cached."""
+    return dumps(name)
+
+
+def encode_message(name: str, message: str) -> bytes:
+    """Return the data for a message command, as would be produced by
+    WebSocketProtocol.send('message', name, message)."""
+    return message_template % (encode_name(name), dumps(message))
+
+
+def build_frame(data: bytes) -> bytes:
+    """Return data wrapped in a websocket text frame. Frames sent by servers
+    are not masked, and we never compress them, so the same frame can be
+    written to any number of sockets."""
+    length = len(data)
+    if length < 126:
+        header = pack('!BB', 0x81, length)
+    elif length < 0x10000:
+        header = pack('!BBH', 0x81, 126, length)
+    else:
+        header = pack('!BBQ', 0x81, 127, length)
+    return header + data
+
+
+def send_message(message: str, name: Optional[str] = None) -> None:
     """Send the provided message to all connected clients. Use the provided
-    name instead of the default one."""
+    name instead of the default one. The frame is only built once, no matter
+    how many clients it is sent to. The message isn't actually sent until the
+    reactor gets round to calling flush_broadcasts, so that a burst of messages
+    doesn't stop the reactor from reading from other sockets in the
+    meantime."""
+    if not connections:  # There is nobody to send to.
+        return
+    if name is None:
+        name = WebSocketProtocol.default_name
+    pending_broadcasts.append(
+        (message, name, build_frame(encode_message(name, message)))
+    )
+    if len(pending_broadcasts) == 1:  # Nothing is scheduled yet.
+        reactor.callLater(0, flush_broadcasts)
+
+
+def flush_broadcasts() -> None:
+    """Send all pending broadcasts to all connected clients."""
+    broadcasts = pending_broadcasts.copy()
+    pending_broadcasts.clear()
+    # Log each message once rather than once for every connection. This is
+    # done here so the number of recipients is the number actually sent to.
+    for message, name, frame in broadcasts:
+        log.msg(message, name=name, recipients=len(connections))
+    frames = [frame for message, name, frame in broadcasts]
     for connection in connections:
-        connection.message(message, name=name)
+        for frame in frames:
+            connection.send_frame(frame)
 
 
 class WebSocketProtocol(WebSocketServerProtocol):
     """This class is used for handling data from websockets and should not be
     confused with the Klein instance which handles pure HTTP requests."""
 
+    # These are all set from the command line.
+    default_name: ClassVar[str] = parser.get_default('default_name')
+    outbox_size: ClassVar[int] = parser.get_default('outbox_size')
+    max_drops: ClassVar[int] = parser.get_default('max_drops')
+
+    # listenWS only listens over TCP, and nothing is written before the
+    # connection is made, so the transport is never None when we use it.
+    transport: ITCPTransport
+
     def disconnect(self, message=None):
         """Disconnect this socket. If message is not None then the message will
         be sent first."""
         if message is not None:
             self.message(message)
-        self.transport.loseConection()
+        self.transport.loseConnection()
 
     def log_message(self, message, **kwargs):
         """Log a message using twisted.python.log."""
-        kwargs.setdefault('host', self.host)
-        kwargs.setdefault('port', self.port)
+        kwargs.setdefault('address', self.address)
         log.msg(message, **kwargs)
 
-    def send(self, name, *args, **kwargs):
+    def send(self, name: str, *args: object, **kwargs: object) -> None:
         """Send a command named name with the provided args and kwargs to this
         socket."""
-        data = dumps(dict(name=name, args=args, kwargs=kwargs))
-        self.sendMessage(data.encode())
+        self.send_frame(
+            build_frame(dumps(dict(name=name, args=args, kwargs=kwargs)))
+        )
 
-    def message(self, message, name=None):
+    def send_frame(self, frame: bytes) -> None:
+        """Send a frame made with build_frame to this socket. The frame is
+        queued in the outbox until the socket can take it. If the outbox is
+        full then the oldest message is dropped to make room, so that one slow
+        client can't hold everyone else up."""
+        if self.state == self.STATE_CLOSED:  # Already dropped.
+            return
+        if len(self.outbox) == self.outbox.maxlen:
+            self.drops += 1
+            if self.drops >= self.max_drops:
+                self.log_message('Too many messages dropped.')
+                # A client that isn't reading would never let loseConnection
+                # flush the transport's buffer, so abort instead.
+                return self.dropConnection(abort=True)
+        self.outbox.append(frame)
+        self.drain()
+
+    def drain(self) -> None:
+        """Send as much of the outbox as the transport will accept. The frames
+        are written straight to the transport, since they are already
+        complete."""
+        while (
+            self.outbox and not self.paused and self.state == self.STATE_OPEN
+        ):
+            self.transport.write(self.outbox.popleft())
+
+    # The next three methods make this protocol a push producer for its own
+    # transport, so the transport can tell us when its buffer fills up.
+
+    def pauseProducing(self):
+        """The transport's buffer is full, so stop writing to it."""
+        self.paused = True
+
+    def resumeProducing(self):
+        """The transport's buffer has emptied, so carry on writing."""
+        self.paused = False
+        self.drain()
+
+    def stopProducing(self):
+        """The connection is going away, so there is no point holding on to
+        anything."""
+        self.outbox.clear()
+
+    def message(self, message: str, name: Optional[str] = None) -> None:
         """Send a message to this socket. If name is None then the default name
         will be used."""
         if name is None:
-            name = self.factory.default_name
+            name = self.default_name
         self.log_message(message, name=self.name)
-        self.send('message', name, message)
+        self.send_frame(build_frame(encode_message(name, message)))
 
     def message_lines(self, lines, name=None):
         """Send a message which spans several lines. The name will only be
         printed once."""
         return self.message('\n'.join(lines), name=name)
 
-    def connectionMade(self):
+    def connectionMade(self) -> None:
         """The socket is connected. Setup some initial values and add this
-        socket to the connections list."""
+        socket to the connections set."""
         super().connectionMade()
-        connections.append(self)
+        connections.add(self)
         self.name = None  # Don't let them transmit unless they've set a name.
+        # Messages waiting to be sent. Nothing can be sent until the websocket
+        # handshake is complete, and after that the outbox only fills when the
+        # client isn't reading fast enough.
+        self.outbox: Deque[bytes] = deque(maxlen=self.outbox_size)
+        self.drops = 0  # The number of messages dropped from the outbox.
+        self.paused = False  # Set when the transport's buffer is full.
+        self.registerProducer(self, True)
         peer = self.transport.getPeer()  # Connection information.
         self.host = peer.host
         self.port = peer.port
+        self.address = f'{peer.host}:{peer.port}'  # Never changes.
         self.log_message('Conected.')
         self.message('Welcome.')
         self.message(
@@ -128,6 +296,11 @@ class WebSocketProtocol(WebSocketServerProtocol):
             name='Suggestion'
         )
 
+    def onOpen(self):
+        """The websocket handshake is complete, so send anything which was
+        queued while it was in progress."""
+        self.drain()
+
     def connectionLost(self, reason):
         """This socket has been disconnected for some reason. Log the reason
         and remove this connection. Not overriding
@@ -135,17 +308,16 @@ class WebSocketProtocol(WebSocketServerProtocol):
         specific to websockets."""
         super().connectionLost(reason)
         self.log_message(reason.getErrorMessage())
-        # It is highly unlikely that this socket isn't in the list, but best to
-        # check because some of the things that haunt the internet don't do
-        # stuff as we'd expect and they might disconnect before our onOpen
-        # method has been called.
-        if self in connections:
-            connections.remove(self)
-        if self.name in names:  # They might not have set a name.
+        # It is highly unlikely that this socket isn't in the set, but
+        # discard doesn't mind because some of the things that haunt the
+        # internet don't do stuff as we'd expect and they might disconnect
+        # before our onOpen method has been called.
+        connections.discard(self)
+        if names.get(self.name) is self:  # They might not have set a name.
+            del names[self.name]
             send_message(f'{self.name} has left the server.')
-            names.remove(self.name)
 
-    def onMessage(self, payload, is_binary):
+    def onMessage(self, payload: bytes, is_binary: bool) -> None:
         """A message was received. This will be a string of raw data which we
         expect to be json-encoded. Of course it is entirely likely that
         whatever sent it is just messing with us so we're not trying too hard
@@ -155,16 +327,22 @@ class WebSocketProtocol(WebSocketServerProtocol):
             # Kick them off as we don't support binary.
             self.log_message('Binary string received.')
             return self.disconnect('No binary allowed.')
+        if payload[:1] != b'[':
+            # Commands are always sent as arrays, so there's no point asking
+            # the decoder what's wrong with this.
+            self.log_message('Invalid message received.')
+            return self.disconnect('Invalid message.')
         # The below line assumes the message is in the right format. If it's
         # not they will be disconnected by the resulting error.
-        name, args, kwargs = loads(payload)
+        msg = decoder.decode(payload)
+        name = msg.name
         # Let's find the command they're trying to call.
         func = commands.get(name)
         if func is None:  # Command not found.
             return self.message(f'Unsupported command: {name}.')
         # Call the valid function. Any errors thrown at this point will still
         # cause a disconnect.
-        func(self, *args, **kwargs)
+        func(self, *msg.args, **msg.kwargs)
 
 
 # Let's add commands.
@@ -176,29 +354,27 @@ def name(con, name):
     """Set your name."""
     if not name:  # We don't want blank names.
         con.message('You must give a name.')
-    elif name in names:  # That name is already taken.
+    elif names.get(name, con) is not con:  # Someone else is using it.
         con.message('You cannot use that name.')
+    elif name == con.name:  # They aren't actually changing anything.
+        con.message('Name unchanged.')
     else:  # This is a good name.
-        if con.name in names:  # Allow the name to be used again.
-            names.remove(con.name)
         old = con.name  # For comparison.
-        if old == name:  # They aren't actually changing anything.
-            con.message('Name unchanged.')
-        else:  # It is different.
-            con.name = name  # Set the new name.
-            # Get the client to store their name in a cookie to send next time
-            # they connect.
-            con.send('name', name)
-            names.add(name)  # Add it to the set of names.
-            # In the below lines we use a variable to store the message. This
-            # means if the API ever changes we only need to change the line
-            # that sends the message.
-            if old:  # This was a name change.
-                msg = f'{old} is now known as {con.name}.'
-            else:  # They are setting their name for the first time.
-                msg = f'{con.name} has joined the server.'
-            # Send the message:
-            send_message(msg)
+        names.pop(old, None)  # Allow the old name to be used again.
+        names[name] = con  # Claim the new name.
+        con.name = name  # Set the new name.
+        # Get the client to store their name in a cookie to send next time
+        # they connect.
+        con.send('name', name)
+        # In the below lines we use a variable to store the message. This
+        # means if the API ever changes we only need to change the line that
+        # sends the message.
+        if old:  # This was a name change.
+            msg = f'{old} is now known as {con.name}.'
+        else:  # They are setting their name for the first time.
+            msg = f'{con.name} has joined the server.'
+        # Send the message:
+        send_message(msg)
 
 
 @command
@@ -221,12 +397,12 @@ def message(con, text):
 def who(con):
     """Show who's connected."""
     results = ['Who listing:']
+    add = results.append  # Saves looking up the method for every connection.
     for connection in connections:
-        if connection.name is None:
+        name = connection.name  # Only look the attribute up once.
+        if name is None:
             continue
-        results.append(
-            f'{connection.name} from {connection.host}:{connection.port}'
-        )
+        add(f'{name} from {connection.address}')
     con.message_lines(results)
 
 
@@ -246,17 +422,9 @@ def disconnect(con):
 def help(con, command):
     """Get help on a command or list all commands."""
     if command is None:  # Show them all.
-        results = ['<h4>Commands</h4>', '<dl>']
-        for name, func in commands.items():
-            results.append(f'<dt>/{name}</dt>')
-            results.append('<dd>' + getdoc(func) + '</dd>')
-        results.append('</dl>')
-    elif command in commands:  # They want to know about a specific command.
-        results = [f'<h4>Help on /{command}</h4>']
-        results.append('<p>' + getdoc(commands[command]) + '</p>')
-    else:  # They want to know about a command that doesn't exist.
-        results = ['No such command.']
-    con.message_lines(results)
+        con.message(help_all)
+    else:  # They want to know about a specific command.
+        con.message(help_texts.get(command, 'No such command.'))
 
 
 @command
@@ -284,6 +452,21 @@ def guessthenumber(con, guess):
         con.message(f'Sorry, the number was {actual}.')
 
 
+# The commands can't change once the server is running, so the help text is
+# built once here rather than every time someone asks for it.
+help_texts = {}  # The help for each command.
+help_lines = ['<h4>Commands</h4>', '<dl>']  # The help for all commands.
+for command_name, doc in command_docs.items():
+    help_texts[command_name] = (
+        f'<h4>Help on /{command_name}</h4>\n<p>{doc}</p>'
+    )
+    help_lines.append(f'<dt>/{command_name}</dt>')
+    help_lines.append(f'<dd>{doc}</dd>')
+help_lines.append('</dl>')
+help_all = '\n'.join(help_lines)
+del command_name, doc, help_lines  # Don't leave these lying around.
+
+
 # Web stuff. This is separate to the socket stuff and just renders the HTML,
 # Javascript and MP3 data to clients' web browsers.
 app = Klein()  # We use this to serve HTML.
@@ -295,23 +478,32 @@ loader = FileSystemLoader(os.curdir)
 # The environment handles templating with Jinja2. To see the raw files open
 # chat.html and chat.js. It is worth noting that Jinja2 knows nothing about the
 # web and can be used anywhere templating is required.
-environment = Environment(loader=loader)
-index_kwargs = {}  # These are used for rendering from the index method.
+# Templates are never edited while the server is running, so there is no need
+# to check the filesystem for changes every time one is used.
+environment = Environment(loader=loader, auto_reload=False, cache_size=-1)
+index_template = environment.get_template('chat.html')  # Compiled once.
+index_kwargs: Dict[str, object] = {}  # Used to render index_template.
+index_html = b''  # The rendered page, set once index_kwargs are known.
+
+
+# The notification sound. File streams the data from disk and handles range
+# requests, so there's no need to hold it in memory.
+notify = File('notify.mp3', defaultType='audio/mpeg')
 
 
 @app.route('/notify.mp3')
 def notify_mp3(request):
     """We use a twisted.web.static.File instance to render the mp3 as
     binary data."""
-    return File('notify.mp3')
+    return notify
 
 
 @app.route('/')
 def index(request):
-    """Return the main page."""
-    # The template describing chat.html:
-    template = environment.get_template('chat.html')
-    return template.render(**index_kwargs)
+    """Return the main page. It is rendered once at startup, since nothing it
+    depends on changes while the server is running."""
+    request.setHeader(b'content-type', b'text/html; charset=utf-8')
+    return index_html
 
 
 if __name__ == '__main__':
@@ -323,8 +515,16 @@ if __name__ == '__main__':
     )
 
     # Set up the default name from the command line.
-    factory.default_name = args.default_name
-    names.add(factory.default_name)
+    WebSocketProtocol.default_name = args.default_name
+    WebSocketProtocol.outbox_size = args.outbox_size
+    WebSocketProtocol.max_drops = args.max_drops
+    # Make Autobahn drop anyone who sends too much data, before it has all
+    # been read into memory.
+    factory.setProtocolOptions(
+        maxFramePayloadSize=args.max_message_size,
+        maxMessagePayloadSize=args.max_message_size
+    )
+    names[args.default_name] = None  # Nobody can use this name.
 
     # factory.protocol will be returned by factory.buildProtocol.
     # This is a shortcut instead of subclassing WebSocketServerFactory and
@@ -340,5 +540,6 @@ if __name__ == '__main__':
         hostname=getfqdn(), http_port=args.http_port,
         websocket_port=args.websocket_port
     )
+    index_html = index_template.render(**index_kwargs).encode('utf-8')
     listenWS(factory, interface=args.interface)  # Listen for websockets.
     app.run(host=args.interface, port=args.http_port)  # Main loop.